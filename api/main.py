@@ -1,24 +1,33 @@
 # main.py
-from fastapi import FastAPI, Request, Header, HTTPException, Depends, File, UploadFile, Form
+from fastapi import FastAPI, Request, Header, HTTPException, Depends, File, UploadFile, Form, BackgroundTasks
 from fastapi.responses import JSONResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from jose import JWTError, jwt
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel, ConfigDict, ValidationError, model_validator
+from jose import JWTError
 from workflows.processor import process_agent_event
-import hmac, hashlib, os, json, base64
+import hmac, hashlib, os, base64
+import orjson
 from dotenv import load_dotenv
-from typing import Any, Dict, Optional, List
-import traceback
+from typing import Any, BinaryIO, Dict, Iterator, Optional, List, Tuple
 from twilio.rest import Client
 import bcrypt
 import glob
-from datetime import datetime, timedelta
+from datetime import date
+from functools import lru_cache
+from contextlib import asynccontextmanager
+from pathlib import Path
 import time
 import io
 import csv
+import codecs
+import calendar
 import re
-import pandas as pd  # Para soportar .xls/.xlsx además de .csv
+import atexit
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 
 # Importar las funciones del servicio que acabamos de añadir
 from services.elevenlabs_service import (
@@ -41,21 +50,60 @@ SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 BOT_CONFIG_DIR = os.path.join(SCRIPT_DIR, '..', 'agents')
 BOT_CONFIG_DIR = os.path.abspath(BOT_CONFIG_DIR)
 
+# =========================
+# Logging
+# =========================
+# Los handlers escriben a stdout desde un hilo aparte (QueueListener): el event loop
+# sólo encola el registro y no se bloquea en el write() de cada línea.
+logger = logging.getLogger(__name__)
+
+def _setup_logging() -> None:
+    if logger.handlers:  # evitar handlers duplicados si el módulo se recarga
+        return
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    listener = QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    logger.addHandler(QueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+_setup_logging()
+
 # =========================
 # Cargar .env (Render/local)
 # =========================
 SECRET_ENV_PATH = "/etc/secrets/.env"
 if os.path.exists(SECRET_ENV_PATH):
     load_dotenv(SECRET_ENV_PATH)
-    print(f"✅ Archivo .env cargado desde {SECRET_ENV_PATH}")
+    logger.info("✅ Archivo .env cargado desde %s", SECRET_ENV_PATH)
 else:
     load_dotenv()
-    print("⚠️ Usando .env local")
+    logger.warning("⚠️ Usando .env local")
+
+# En producción LOG_LEVEL=WARNING evita formatear los mensajes informativos
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
 
 # =========================
 # App (+ CORS)
 # =========================
-app = FastAPI()
+class ORJSONResponse(JSONResponse):
+    """
+    Respuesta JSON serializada con orjson. Se define aquí porque la ORJSONResponse de
+    fastapi.responses emite FastAPIDeprecationWarning en las versiones actuales.
+    """
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Índices de agentes en memoria antes de aceptar la primera petición
+    _load_all_agent_configs()
+    yield
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 # 🔓 CORS abierto para facilitar conexión desde WordPress/otros orígenes
 app.add_middleware(
     CORSMiddleware,
@@ -64,7 +112,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-print("✅ FastAPI cargado correctamente y esperando eventos de ElevenLabs…")
+logger.info("✅ FastAPI cargado correctamente y esperando eventos de ElevenLabs…")
 
 # =========================
 # Config HMAC
@@ -72,8 +120,15 @@ print("✅ FastAPI cargado correctamente y esperando eventos de ElevenLabs…")
 HMAC_SECRET = (os.getenv("ELEVENLABS_HMAC_SECRET") or "").strip()
 SKIP_HMAC = (os.getenv("ELEVENLABS_SKIP_HMAC") or "false").strip().lower() == "true"
 
+# Formato de firma aceptado. ElevenLabs firma "t.body" (canónico).
+# Valores: t_dot_body | body | t_body | all (all = compatibilidad con los tres formatos)
+HMAC_VARIANTS = ("t_dot_body", "body", "t_body")
+HMAC_VARIANT = (os.getenv("ELEVENLABS_HMAC_VARIANT") or "t_dot_body").strip().lower()
+
 if not HMAC_SECRET and not SKIP_HMAC:
     raise RuntimeError("❌ Falta ELEVENLABS_HMAC_SECRET (o define ELEVENLABS_SKIP_HMAC=true para omitir).")
+if HMAC_VARIANT != "all" and HMAC_VARIANT not in HMAC_VARIANTS:
+    raise RuntimeError(f"❌ ELEVENLABS_HMAC_VARIANT inválido: {HMAC_VARIANT} (usa {', '.join(HMAC_VARIANTS)} o all).")
 
 # =========================
 # Config Twilio
@@ -88,179 +143,306 @@ if all([TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, TWILIO_PHONE_NUMBER]):
     try:
         twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
         twilio_configurado = True
-        print("✅ Cliente de Twilio configurado exitosamente.")
+        logger.info("✅ Cliente de Twilio configurado exitosamente.")
     except Exception as e:
-        print(f"⚠️  ADVERTENCIA: Error al configurar cliente de Twilio: {e}")
+        logger.warning("⚠️  ADVERTENCIA: Error al configurar cliente de Twilio: %s", e)
 else:
-    print("⚠️  ADVERTENCIA: Faltan variables de entorno de Twilio. El SMS no funcionará.")
+    logger.warning("⚠️  ADVERTENCIA: Faltan variables de entorno de Twilio. El SMS no funcionará.")
 
 # =========================
 # Lógica de Mapeo de Agentes
 # =========================
+# Índices en memoria construidos a partir de BOT_CONFIG_DIR (se cargan al arrancar)
 AGENT_ID_TO_FILENAME_CACHE: Dict[str, str] = {}
+AGENT_USERNAME_TO_CONFIG_CACHE: Dict[str, Dict[str, Any]] = {}
+_BOT_SLUG_TO_CONFIG: Dict[str, Dict[str, Any]] = {}
+# Huella (nombre, st_mtime_ns) de los JSON con los que se construyeron los índices
+_AGENT_INDEX_STAMP: Optional[Tuple[Tuple[str, int], ...]] = None
+# Búsquedas negativas recientes (agent_id -> instante de expiración) para no re-escanear IDs falsos
+_MISSING_AGENT_IDS: Dict[str, float] = {}
+MISSING_AGENT_TTL_SECS = 30
 
-def map_agent_id_to_filename(agent_id: str) -> Optional[str]:
+# JSON ya parseados: ruta -> (st_mtime_ns, config)
+_CONFIG_CACHE: Dict[str, Tuple[int, Dict[str, Any]]] = {}
+
+def _load_config(path: str) -> Dict[str, Any]:
     """
-    Busca el nombre del archivo de configuración (ej. 'sundin.json') dado el ID
-    largo de ElevenLabs (ej. 'agent_8301...').
+    Lee y parsea un JSON de configuración; reutiliza el resultado mientras su mtime no cambie.
+    Lanza OSError/ValueError si el archivo no existe o no es JSON válido.
     """
+    mtime = os.stat(path).st_mtime_ns
+    cached = _CONFIG_CACHE.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
 
-    # 1. Intentar encontrar en el caché
-    if agent_id in AGENT_ID_TO_FILENAME_CACHE:
-        return AGENT_ID_TO_FILENAME_CACHE[agent_id]
+    config = orjson.loads(Path(path).read_bytes())
+    _CONFIG_CACHE[path] = (mtime, config)
+    return config
 
-    # 2. Si no está en caché, recorrer los archivos del directorio
-    try:
-        if not os.path.isdir(BOT_CONFIG_DIR):
-            print(f"❌ Directorio de agentes no encontrado. Ruta calculada: {BOT_CONFIG_DIR}")
-            return None
+def _scan_agent_files() -> List[Tuple[str, str, int]]:
+    """
+    (nombre, ruta, st_mtime_ns) de los JSON de agentes, ordenados por nombre.
+    Lanza OSError si el directorio no existe.
+    """
+    with os.scandir(BOT_CONFIG_DIR) as it:
+        return sorted(
+            (e.name, e.path, e.stat().st_mtime_ns)
+            for e in it
+            if e.name.endswith(".json") and not e.name.startswith("_") and e.is_file()
+        )
 
-        print(f"Buscando el ID de Agente {agent_id} en el directorio: {BOT_CONFIG_DIR}")
+def _files_stamp(files: List[Tuple[str, str, int]]) -> Tuple[Tuple[str, int], ...]:
+    return tuple((name, mtime) for name, _, mtime in files)
 
-        for filename in os.listdir(BOT_CONFIG_DIR):
-            if not filename.endswith(".json") or filename.startswith("_"):
-                continue
+def _load_all_agent_configs(files: Optional[List[Tuple[str, str, int]]] = None) -> None:
+    """
+    Recorre BOT_CONFIG_DIR una sola vez y reconstruye los índices de agentes
+    (ID de ElevenLabs -> archivo, 'agent_user' -> config, slug -> config).
+    """
+    global AGENT_ID_TO_FILENAME_CACHE, AGENT_USERNAME_TO_CONFIG_CACHE, _BOT_SLUG_TO_CONFIG, _AGENT_INDEX_STAMP
 
-            filepath = os.path.join(BOT_CONFIG_DIR, filename)
+    if not os.path.isdir(BOT_CONFIG_DIR):
+        logger.error("❌ Directorio de agentes no encontrado. Ruta calculada: %s", BOT_CONFIG_DIR)
+        return
 
-            with open(filepath, 'r', encoding='utf-8') as f:
-                config: Dict[str, Any] = json.load(f)
+    if files is None:
+        files = _scan_agent_files()
+    by_agent_id: Dict[str, str] = {}
+    by_username: Dict[str, Dict[str, Any]] = {}
+    by_slug: Dict[str, Dict[str, Any]] = {}
 
-                # 3. Comprobar si el ID del agente de ElevenLabs coincide
-                if (
-                    config.get("elevenlabs_agent_id") == agent_id
-                    or config.get("agent_id") == agent_id
-                    or config.get("eleven_agent_id") == agent_id
-                ):
-                    # 4. Encontramos la coincidencia, guardamos en caché y devolvemos
-                    AGENT_ID_TO_FILENAME_CACHE[agent_id] = filename
-                    print(f"✅ Mapeo encontrado: {agent_id} -> {filename}")
-                    return filename
+    for filename, path, _ in files:
+        try:
+            config = _load_config(path)
+        except Exception as e:
+            logger.error("💥 Error leyendo %s: %s", path, e)
+            continue
+        if not isinstance(config, dict):
+            continue
+
+        bot_slug = filename.replace(".json", "")
+        by_slug[bot_slug] = config
+
+        # El primer archivo que declare el ID gana (mismo orden que el recorrido anterior)
+        for key in ("elevenlabs_agent_id", "agent_id", "eleven_agent_id"):
+            value = config.get(key)
+            if value:
+                by_agent_id.setdefault(value, filename)
+
+        username = config.get("agent_user")
+        if username and username not in by_username:
+            # ¡Guardamos el slug (nombre de archivo) DENTRO de la config para usarlo!
+            by_username[username] = {**config, "_bot_slug": bot_slug}
+
+    # Se reemplazan los dicts completos (no clear()+update()): una búsqueda concurrente
+    # desde otro hilo ve el índice anterior o el nuevo, nunca uno vacío
+    AGENT_ID_TO_FILENAME_CACHE = by_agent_id
+    AGENT_USERNAME_TO_CONFIG_CACHE = by_username
+    _BOT_SLUG_TO_CONFIG = by_slug
+    _MISSING_AGENT_IDS.clear()
+    _AGENT_INDEX_STAMP = _files_stamp(files)
+
+    logger.info("✅ %s configuraciones de agente cargadas desde %s", len(by_slug), BOT_CONFIG_DIR)
+
+def _reload_agent_configs_if_changed() -> None:
+    """
+    Recarga los índices si algún JSON se añadió, eliminó o modificó. Se compara el
+    mtime de cada archivo: editar un archivo existente no cambia el del directorio.
+    """
+    try:
+        files = _scan_agent_files()
+    except OSError:
+        files = None
+    if files is None or _files_stamp(files) != _AGENT_INDEX_STAMP:
+        _load_all_agent_configs(files)
 
-        # Si el loop termina sin encontrarlo
-        print(f"❌ No se encontró ningún archivo JSON con el ID de agente {agent_id} en {BOT_CONFIG_DIR}.")
-        return None
+def map_agent_id_to_filename(agent_id: str) -> Optional[str]:
+    """
+    Busca el nombre del archivo de configuración (ej. 'sundin.json') dado el ID
+    largo de ElevenLabs (ej. 'agent_8301...').
+    """
+    filename = AGENT_ID_TO_FILENAME_CACHE.get(agent_id)
+    if filename is not None:
+        return filename
 
-    except Exception as e:
-        print(f"💥 Error al intentar mapear el agente: {e}")
+    now = time.monotonic()
+    if _MISSING_AGENT_IDS.get(agent_id, 0) > now:
         return None
 
-# --- NUEVO HELPER DE LOGIN (AÑADIDO) ---
-AGENT_USERNAME_TO_CONFIG_CACHE: Dict[str, Dict[str, Any]] = {}
+    # Puede que se haya añadido un archivo nuevo desde el arranque
+    _reload_agent_configs_if_changed()
+    filename = AGENT_ID_TO_FILENAME_CACHE.get(agent_id)
+
+    if filename is None:
+        if len(_MISSING_AGENT_IDS) > 1024:
+            _MISSING_AGENT_IDS.clear()
+        _MISSING_AGENT_IDS[agent_id] = now + MISSING_AGENT_TTL_SECS
+        logger.error("❌ No se encontró ningún archivo JSON con el ID de agente %s en %s.", agent_id, BOT_CONFIG_DIR)
+    return filename
 
+# --- NUEVO HELPER DE LOGIN (AÑADIDO) ---
 def map_username_to_agent_data(username: str) -> Optional[Dict[str, Any]]:
     """
     Busca la configuración completa del agente (ej. 'sundin.json') dado el 'agent_user'
     definido en el archivo de configuración.
     """
+    config = AGENT_USERNAME_TO_CONFIG_CACHE.get(username)
+    if config is None:
+        _reload_agent_configs_if_changed()
+        config = AGENT_USERNAME_TO_CONFIG_CACHE.get(username)
 
-    # 1. Intentar encontrar en el caché
-    if username in AGENT_USERNAME_TO_CONFIG_CACHE:
-        return AGENT_USERNAME_TO_CONFIG_CACHE[username]
+    if config is None:
+        logger.error("❌ No se encontró ningún archivo JSON con el 'agent_user' %s.", username)
+    return config
 
-    # 2. Si no está en caché, recorrer los archivos del directorio
-    try:
-        if not os.path.isdir(BOT_CONFIG_DIR):
-            print(f"❌ Directorio de agentes no encontrado. Ruta calculada: {BOT_CONFIG_DIR}")
-            return None
-
-        print(f"Buscando el 'agent_user' {username} en el directorio: {BOT_CONFIG_DIR}")
-
-        for filename in os.listdir(BOT_CONFIG_DIR):
-            if not filename.endswith(".json") or filename.startswith("_"):
-                continue
+# =========================
+# Funciones de Soporte
+# =========================
+# Cabecera "t=...,v0=...": una sola pasada extrae ambos campos
+_SIG_RE = re.compile(r"(?:^|,)\s*(t|v0)=([^,\s]+)")
 
-            filepath = os.path.join(BOT_CONFIG_DIR, filename)
+@lru_cache(maxsize=4)
+def _hmac_template(secret: str) -> "hmac.HMAC":
+    """
+    Devuelve un HMAC-SHA256 ya inicializado con la clave (se calcula una sola vez por secreto).
+    """
+    return hmac.new(secret.encode(), b"", hashlib.sha256)
 
-            with open(filepath, 'r', encoding='utf-8') as f:
-                config: Dict[str, Any] = json.load(f)
+def _hmac_digest(secret: str, *parts: bytes) -> bytes:
+    """
+    Calcula el HMAC-SHA256 de la concatenación de parts copiando la plantilla ya
+    inicializada con la clave (cada parte se pasa a update() sin concatenar en Python).
+    """
+    h = _hmac_template(secret).copy()
+    for part in parts:
+        h.update(part)
+    return h.digest()
 
-                # 3. Comprobar si el 'agent_user' coincide (que crearemos en WordPress)
-                if config.get("agent_user") == username:
-                    # 4. Encontramos la coincidencia, guardamos en caché y devolvemos
-                    # ¡Guardamos el slug (nombre de archivo) DENTRO de la config para usarlo!
-                    config["_bot_slug"] = filename.replace(".json", "")
-                    AGENT_USERNAME_TO_CONFIG_CACHE[username] = config
-                    print(f"✅ Mapeo de usuario encontrado: {username} -> {filename}")
-                    return config
+def _parse_signature(sig_header: Optional[str]) -> Optional[Tuple[bytes, bytes]]:
+    """
+    Extrae (t, v0) de la cabecera de firma como bytes; None si falta o es inválida.
+    """
+    if not sig_header:
+        logger.warning("🚨 No se recibió cabecera HMAC.")
+        return None
 
-        # Si el loop termina sin encontrarlo
-        print(f"❌ No se encontró ningún archivo JSON con el 'agent_user' {username}.")
+    fields = dict(_SIG_RE.findall(sig_header))
+    t, v0 = fields.get("t", ""), fields.get("v0", "")
+    if not v0:
+        logger.warning("🚨 HMAC sin v0.")
         return None
 
-    except Exception as e:
-        print(f"💥 Error al intentar mapear el usuario del agente: {e}")
+    # Decodificamos v0 una sola vez; si no es hex válido, la firma es inválida
+    try:
+        return t.encode(), bytes.fromhex(v0)
+    except ValueError:
+        logger.warning("🚨 HMAC con v0 no hexadecimal.")
         return None
 
-# =========================
-# Funciones de Soporte
-# =========================
+def _signed_prefix(variant: str, t_bytes: bytes) -> Tuple[bytes, ...]:
+    """
+    Partes que preceden al body en el mensaje firmado según la variante.
+    """
+    return {
+        "t_dot_body": (t_bytes, b"."),
+        "body":       (),
+        "t_body":     (t_bytes,),
+    }[variant]
+
 def _verify_hmac(secret: str, body: bytes, sig_header: str) -> bool:
     """
     Verifica firma HMAC.
     """
-    if not sig_header:
-        print("🚨 No se recibió cabecera HMAC.")
+    parsed = _parse_signature(sig_header)
+    if parsed is None:
         return False
+    t_bytes, v0_bytes = parsed
+    variants = HMAC_VARIANTS if HMAC_VARIANT == "all" else (HMAC_VARIANT,)
 
-    t, v0 = "", ""
-    for part in [x.strip() for x in sig_header.split(",")]:
-        if part.startswith("t="):  t = part.split("=", 1)[1]
-        if part.startswith("v0="): v0 = part.split("=", 1)[1]
-    if not v0:
-        print("🚨 HMAC sin v0.")
-        return False
-
-    body_txt = body.decode("utf-8", errors="ignore")
-
-    # Pruebas de compatibilidad con diferentes formatos de firma
-    expected_body   = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
-    expected_t_body = hmac.new(secret.encode(), f"{t}.{body_txt}".encode(), hashlib.sha256).hexdigest()
-    expected_tbody  = hmac.new(secret.encode(), f"{t}{body_txt}".encode(), hashlib.sha256).hexdigest()
-
-    if v0 in (expected_body, expected_t_body, expected_tbody):
-        print("🔏 HMAC válido ✅")
+    # Comparación en tiempo constante (evita ataques de timing)
+    if any(hmac.compare_digest(v0_bytes, _hmac_digest(secret, *_signed_prefix(v, t_bytes), body)) for v in variants):
+        logger.info("🔏 HMAC válido ✅")
         return True
 
     # Debug útil
-    print("🚨 HMAC inválido")
-    print(f"received: {sig_header}")
+    logger.warning("🚨 HMAC inválido")
+    logger.warning("received: %s", sig_header)
     return False
 
-def _normalize_event(data: Dict[str, Any]) -> Dict[str, Any]:
+# Máximo de turnos recorridos / caracteres acumulados del transcript por evento
+TRANSCRIPT_MAX_MSGS = 2000
+TRANSCRIPT_MAX_CHARS = 64_000
+
+def _event_root(data: Any) -> Tuple[Dict[str, Any], Dict[str, Any]]:
     """
-    Normaliza el payload del evento de ElevenLabs.
+    Valida el payload una sola vez y devuelve (data, root), ambos garantizados como dict.
+    ElevenLabs envía los campos dentro de "data"; algunos payloads los traen en la raíz.
     """
-    root = data.get("data", data) if isinstance(data, dict) else {}
-    agent_id = (
+    if not isinstance(data, dict):
+        return {}, {}
+    root = data.get("data", data)
+    return data, (root if isinstance(root, dict) else {})
+
+def _clean_str(value: Any) -> Optional[str]:
+    """Devuelve value sin espacios, o None si está vacío o no es texto."""
+    if isinstance(value, str):
+        return value.strip() or None
+    return None
+
+def _extract_agent_id(data: Dict[str, Any]) -> Optional[str]:
+    """
+    Obtiene sólo el agent_id del payload (sin recorrer el transcript).
+    """
+    data, root = _event_root(data)
+    agent = root.get("agent")
+    return (
         root.get("agent_id")
-        or (root.get("agent") or {}).get("id")
+        or (agent.get("id") if isinstance(agent, dict) else None)
         or data.get("agent_id")
         or None
     )
 
+def _normalize_event(data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Normaliza el payload del evento de ElevenLabs.
+    """
+    raw = data
+    data, root = _event_root(data)
+    agent_id = _extract_agent_id(data)
+
     transcript_list = root.get("transcript") or root.get("transcription") or []
     transcript_text = ""
     if isinstance(transcript_list, list):
-        try:
-            transcript_text = " ".join(
-                (t.get("message", "") or "").strip()
-                for t in transcript_list
-                if isinstance(t, dict) and t.get("role") == "user"
-            ).strip()
-        except Exception:
-            transcript_text = ""
+        parts: List[str] = []
+        total_chars = 0
+        for i, t in enumerate(transcript_list):
+            # Límite de trabajo por webhook ante transcripts anómalos: se acota el número
+            # de turnos recorridos (de cualquier rol), no sólo los mensajes guardados
+            if i >= TRANSCRIPT_MAX_MSGS or total_chars >= TRANSCRIPT_MAX_CHARS:
+                logger.warning(
+                    "⚠️ Transcript truncado: %s de %s turnos recorridos, %s caracteres.",
+                    i, len(transcript_list), total_chars,
+                )
+                break
+            if not isinstance(t, dict) or t.get("role") != "user":
+                continue
+            message = t.get("message")
+            if message and isinstance(message, str):
+                message = message.strip()
+                if message:
+                    parts.append(message)
+                    total_chars += len(message) + 1
+        transcript_text = " ".join(parts)[:TRANSCRIPT_MAX_CHARS]
     elif isinstance(transcript_list, str):
         transcript_text = transcript_list.strip()
 
-    caller = called = None
+    # Acceso directo; si falta algún nivel (o no es dict) no hay caller/called
     try:
-        client_data = root.get("conversation_initiation_client_data", {}) or {}
-        dyn = client_data.get("dynamic_variables", {}) or {}
-        caller = (dyn.get("system__caller_id") or "").strip() or None
-        called = (dyn.get("system__called_number") or "").strip() or None
-    except Exception:
-        pass
+        dyn = root["conversation_initiation_client_data"]["dynamic_variables"]
+        caller = _clean_str(dyn.get("system__caller_id"))
+        called = _clean_str(dyn.get("system__called_number"))
+    except (KeyError, TypeError, AttributeError):
+        caller = called = None
 
     return {
         "agent_id": agent_id,
@@ -268,48 +450,93 @@ def _normalize_event(data: Dict[str, Any]) -> Dict[str, Any]:
         "caller": caller,
         "called": called,
         "timestamp": root.get("timestamp") or data.get("timestamp"),
-        "raw": data,
+        "raw": raw,
     }
 
 # =========================
 # Webhook (Ruta Principal de ElevenLabs)
 # =========================
-@app.post("/api/agent-event")
-async def handle_agent_event(
+class InvalidSignatureError(HTTPException):
+    """
+    Firma HMAC inválida. Se lanza desde la dependencia (fuera del try/except del handler),
+    así que tiene su propio exception handler para responder con el mismo formato
+    {"error": ...} que el resto de errores del webhook.
+    """
+    def __init__(self) -> None:
+        super().__init__(status_code=401, detail="Invalid HMAC signature.")
+
+@app.exception_handler(InvalidSignatureError)
+async def _invalid_signature_handler(request: Request, exc: InvalidSignatureError) -> ORJSONResponse:
+    return ORJSONResponse(status_code=exc.status_code, content={"error": exc.detail})
+
+async def verify_signature(
     request: Request,
     elevenlabs_signature: str = Header(default=None, alias="elevenlabs-signature"),
-):
-    try:
-        body_bytes = await request.body()
+) -> bytes:
+    """
+    Dependencia de FastAPI: lee el body, verifica la firma HMAC y devuelve los bytes crudos.
+    Una firma inválida se rechaza con 401 antes de entrar al handler.
+    """
+    if SKIP_HMAC:
+        logger.warning("⚠️ HMAC BYPASS ACTIVADO (ELEVENLABS_SKIP_HMAC=true)")
+        return await request.body()
 
-        # 1. Verificación HMAC
-        if not SKIP_HMAC:
-            sig_header = (
-                elevenlabs_signature
-                or request.headers.get("elevenlabs-signature")
-                or request.headers.get("ElevenLabs-Signature")
-            )
-            if not _verify_hmac(HMAC_SECRET, body_bytes, sig_header):
-                raise HTTPException(status_code=401, detail="Invalid HMAC signature.")
-        else:
-            print("⚠️ HMAC BYPASS ACTIVADO (ELEVENLABS_SKIP_HMAC=true)")
+    # Con "all" hay que probar varias variantes: se necesita el body completo
+    if HMAC_VARIANT == "all":
+        body_bytes = await request.body()
+        # Los headers de Starlette no distinguen mayúsculas: el alias cubre ambas formas
+        if not _verify_hmac(HMAC_SECRET, body_bytes, elevenlabs_signature):
+            raise InvalidSignatureError()
+        return body_bytes
+
+    # Variante única: el HMAC se calcula a medida que llegan los chunks del body
+    parsed = _parse_signature(elevenlabs_signature)
+    if parsed is None:
+        raise InvalidSignatureError()
+    t_bytes, v0_bytes = parsed
+
+    h = _hmac_template(HMAC_SECRET).copy()
+    for part in _signed_prefix(HMAC_VARIANT, t_bytes):
+        h.update(part)
+    chunks: List[bytes] = []
+    async for chunk in request.stream():
+        h.update(chunk)
+        chunks.append(chunk)
+
+    if not hmac.compare_digest(v0_bytes, h.digest()):
+        logger.warning("🚨 HMAC inválido")
+        logger.warning("received: %s", elevenlabs_signature)
+        raise InvalidSignatureError()
+    logger.info("🔏 HMAC válido ✅")
+    return b"".join(chunks)
 
+@app.post("/api/agent-event")
+async def handle_agent_event(
+    body_bytes: bytes = Depends(verify_signature),  # 1. Verificación HMAC
+):
+    try:
         # 2. Carga y Normalización de datos
+        # El body ya está en memoria: un JSON inválido se rechaza sin segundo intento
         try:
-            data = json.loads(body_bytes.decode("utf-8"))
-        except Exception:
-            data = await request.json()
+            data = orjson.loads(body_bytes)
+        except orjson.JSONDecodeError:
+            raise HTTPException(status_code=400, detail="Invalid JSON payload.")
 
-        normalized = _normalize_event(data)
-        agent_id = normalized.get("agent_id")
+        # Sólo el agent_id primero: la normalización completa (transcript) se hace
+        # después de validar y mapear el agente
+        agent_id = _extract_agent_id(data)
 
         if not agent_id:
             raise HTTPException(status_code=400, detail="Missing agent_id in payload.")
 
-        print(f"🚀 Procesando evento para ID de ElevenLabs: {agent_id}")
+        logger.info("🚀 Procesando evento para ID de ElevenLabs: %s", agent_id)
 
         # 3. 🔑 Mapeo del ID largo al nombre de archivo legible (¡La solución!)
-        config_filename = map_agent_id_to_filename(agent_id)
+        # Acierto en el índice: lookup directo; fallo: posible re-escaneo de disco en el threadpool
+        config_filename = (
+            AGENT_ID_TO_FILENAME_CACHE.get(agent_id)
+            or await run_in_threadpool(map_agent_id_to_filename, agent_id)
+        )
 
         if not config_filename:
             # Si no encuentra el mapeo
@@ -319,29 +546,29 @@ async def handle_agent_event(
         # 4. Procesamiento
         # ✅ CORRECCIÓN CLAVE: Pasamos el nombre legible del agente (ej: "sundin") a processor.py
         agent_name = config_filename.replace(".json", "")
-        result = process_agent_event(agent_name, normalized)
+        normalized = _normalize_event(data)
+        result = await run_in_threadpool(process_agent_event, agent_name, normalized)
 
-        return JSONResponse(status_code=200, content={"status": "ok", "result": result})
+        return ORJSONResponse(status_code=200, content={"status": "ok", "result": result})
 
     except HTTPException as http_err:
-        return JSONResponse(status_code=http_err.status_code, content={"error": http_err.detail})
+        return ORJSONResponse(status_code=http_err.status_code, content={"error": http_err.detail})
     except Exception as e:
-        print(f"💥 Error procesando webhook: {e}")
-        traceback.print_exc()
-        return JSONResponse(status_code=500, content={"error": "internal_error", "detail": str(e)})
+        logger.exception("💥 Error procesando webhook: %s", e)
+        return ORJSONResponse(status_code=500, content={"error": "internal_error", "detail": str(e)})
 
 # =========================
 # Env check
 # =========================
 @app.get("/_envcheck")
-def envcheck():
+async def envcheck():
     keys = [
         "MAIL_FROM","MAIL_USERNAME","MAIL_PASSWORD","MAIL_HOST","MAIL_PORT",
         "ELEVENLABS_HMAC_SECRET","ELEVENLABS_SKIP_HMAC",
         # Añadimos claves usadas por algunas librerías ElevenLabs
         "XI_API_KEY","ELEVENLABS_API_KEY"
     ]
-    return {k: os.getenv(k) for k in keys}
+    return ORJSONResponse(content={k: os.getenv(k) for k in keys})
 
 
 # =========================
@@ -349,21 +576,53 @@ def envcheck():
 # =========================
 # Las funciones de servicio deben estar disponibles en el entorno de Render
 from services.calendar_checker import check_availability
-from services.calendar_service import book_appointment
+from services.calendar_service import book_appointment, APPS_SCRIPT_BREAKER
+from services.resilience import CircuitBreaker, is_transient_error, retry_call
+
+# Tras 5 fallos transitorios seguidos (red/5xx) dejamos de llamar a Twilio durante 30 s.
+# Un 4xx (número inválido o fijo) es del destinatario: no cuenta ni bloquea al siguiente cliente
+TWILIO_BREAKER = CircuitBreaker("twilio", fail_max=5, reset_timeout=30.0, failure_if=is_transient_error)
 
 # Definición de la estructura de datos que esperamos para agendar
-class CitaPayload(dict):
+class CitaPayload(BaseModel):
+    """
+    Modelo Pydantic para validar la estructura del JSON de entrada.
+    """
+    # Como antes del modelo: un teléfono/hora enviado como número se acepta (se pasa a str)
+    model_config = ConfigDict(coerce_numbers_to_str=True)
+
+    cliente_nombre: str
+    fecha: str
+    hora: str
+    telefono: str
+
+def _send_confirmation_sms(telefono: str, nombre: str, fecha: str, hora: str) -> None:
     """
-    Clase simple para validar la estructura del JSON de entrada.
+    Envía el SMS de confirmación de cita con Twilio (se ejecuta como tarea en segundo plano).
     """
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        required_keys = ["cliente_nombre", "fecha", "hora", "telefono"]
-        if not all(k in self for k in required_keys):
-            raise ValueError(f"Payload missing one of required keys: {required_keys}")
+    try:
+        mensaje_sms = (
+            f"In Houston Texas: Hola {nombre}. "
+            f"Le confirmamos su cita para el {fecha} a las {hora}."
+        )
+
+        logger.info("🔄 Enviando SMS de confirmación a %s...", telefono)
+        # Reintentos con backoff + jitter (red/5xx), a través del circuit breaker
+        message = TWILIO_BREAKER.call(
+            retry_call,
+            twilio_client.messages.create,
+            body=mensaje_sms,
+            from_=TWILIO_PHONE_NUMBER,
+            to=telefono
+        )
+        logger.info("✅ SMS enviado exitosamente. SID: %s", message.sid)
+
+    except Exception as sms_error:
+        # Importante: Si falla el SMS, no detenemos todo. Solo lo registramos.
+        logger.warning("⚠️ Falló el envío de SMS, pero la cita FUE AGENDADA. Error: %s", sms_error)
 
 @app.post("/agendar_cita")
-async def agendar_cita_endpoint(request: Request):
+async def agendar_cita_endpoint(request: Request, background_tasks: BackgroundTasks):
     """
     Endpoint que coordina la verificación de disponibilidad y la creación del evento.
     Simula la llamada final que haría la lógica de 'workflows/processor.py'.
@@ -371,23 +630,38 @@ async def agendar_cita_endpoint(request: Request):
     try:
         # 1. Cargar y validar el JSON de la solicitud (Payload)
         try:
-            payload = CitaPayload(await request.json())
-        except ValueError as ve:
-            raise HTTPException(status_code=400, detail=str(ve))
-        except Exception:
-            raise HTTPException(status_code=400, detail="Invalid JSON format.")
-
-        cliente_nombre = payload['cliente_nombre']
-        fecha_str = payload['fecha']
-        hora_str = payload['hora']
+            # Parseo + validación en una sola pasada (pydantic-core)
+            payload = CitaPayload.model_validate_json(await request.body())
+        except ValidationError as ve:
+            # Mensaje corto para el cliente (sin el volcado interno de pydantic)
+            errors = ve.errors()
+            if any(err["type"] == "json_invalid" for err in errors):
+                raise HTTPException(status_code=400, detail="Invalid JSON format.")
+            fields = sorted({str(err["loc"][0]) for err in errors if err["loc"]})
+            detail = f"Missing or invalid keys in payload: {fields}" if fields else "Payload must be a JSON object."
+            raise HTTPException(status_code=400, detail=detail)
+
+        cliente_nombre = payload.cliente_nombre
+        fecha_str = payload.fecha
+        hora_str = payload.hora
+
+        # Si el Apps Script está caído (circuito abierto) fallamos rápido en lugar de esperar timeouts
+        if APPS_SCRIPT_BREAKER.is_open:
+            return ORJSONResponse(
+                status_code=503,
+                content={
+                    "status": "failure",
+                    "message": "Servicio de agendamiento no disponible temporalmente. Intenta más tarde.",
+                }
+            )
 
         # 2. Verificar Disponibilidad (Usando services/calendar_checker.py)
-        print(f"🔄 Verificando disponibilidad para {cliente_nombre} en {fecha_str} a las {hora_str}...")
+        logger.info("🔄 Verificando disponibilidad para %s en %s a las %s...", cliente_nombre, fecha_str, hora_str)
 
-        is_available = check_availability(fecha_str, hora_str)
+        is_available = await run_in_threadpool(check_availability, fecha_str, hora_str)
 
         if not is_available:
-            return JSONResponse(
+            return ORJSONResponse(
                 status_code=409, # 409 Conflict - Recurso no disponible
                 content={
                     "status": "failure",
@@ -396,10 +670,11 @@ async def agendar_cita_endpoint(request: Request):
             )
 
         # 3. Agendar Cita y Guardar Datos (Usando services/calendar_service.py - Webhook de Apps Script)
-        print("✅ Disponible. Procediendo a agendar el evento mediante Apps Script Webhook...")
+        logger.info("✅ Disponible. Procediendo a agendar el evento mediante Apps Script Webhook...")
 
         # book_appointment requiere 6 campos, usamos placeholders para los no provistos en la prueba.
-        book_result = book_appointment(
+        book_result = await run_in_threadpool(
+            book_appointment,
             nombre=cliente_nombre,
             apellido="N/A",         # Placeholder para el test
             telefono="N/A",         # Placeholder para el test
@@ -411,34 +686,19 @@ async def agendar_cita_endpoint(request: Request):
         # 4. Analizar la Respuesta del Webhook de Apps Script
         if book_result.get('status') == 'success':
             success_message = f"Cita agendada con éxito para {cliente_nombre}. Mensaje de Apps Script: {book_result.get('message', 'Éxito.')}"
-            print(f"🎉 Éxito: {success_message}")
+            logger.info("🎉 Éxito: %s", success_message)
 
             # --- INICIO: Enviar SMS de Confirmación con Twilio ---
+            # Se envía en segundo plano: la respuesta no espera a Twilio
             if twilio_configurado:
-                try:
-                    cliente_telefono = payload.get('telefono')
-                    if cliente_telefono:
-                        mensaje_sms = (
-                            f"In Houston Texas: Hola {cliente_nombre}. "
-                            f"Le confirmamos su cita para el {fecha_str} a las {hora_str}."
-                        )
-
-                        print(f"🔄 Enviando SMS de confirmación a {cliente_telefono}...")
-                        message = twilio_client.messages.create(
-                            body=mensaje_sms,
-                            from_=TWILIO_PHONE_NUMBER,
-                            to=cliente_telefono
-                        )
-                        print(f"✅ SMS enviado exitosamente. SID: {message.sid}")
-                    else:
-                        print("⚠️ No se encontró 'telefono' en el payload, no se puede enviar SMS.")
-
-                except Exception as sms_error:
-                    # Importante: Si falla el SMS, no detenemos todo. Solo lo registramos.
-                    print(f"⚠️ Falló el envío de SMS, pero la cita FUE AGENDADA. Error: {sms_error}")
+                cliente_telefono = payload.telefono
+                if cliente_telefono:
+                    background_tasks.add_task(_send_confirmation_sms, cliente_telefono, cliente_nombre, fecha_str, hora_str)
+                else:
+                    logger.warning("⚠️ No se encontró 'telefono' en el payload, no se puede enviar SMS.")
             # --- FIN: Enviar SMS de Confirmación con Twilio ---
 
-            return JSONResponse(
+            return ORJSONResponse(
                 status_code=200,
                 content={
                     "status": "success",
@@ -449,7 +709,7 @@ async def agendar_cita_endpoint(request: Request):
             )
         else:
              # Si el Apps Script falla o devuelve un error
-            return JSONResponse(
+            return ORJSONResponse(
                 status_code=500,
                 content={
                     "status": "failure",
@@ -459,11 +719,10 @@ async def agendar_cita_endpoint(request: Request):
             )
 
     except HTTPException as http_err:
-        return JSONResponse(status_code=http_err.status_code, content={"error": http_err.detail})
+        return ORJSONResponse(status_code=http_err.status_code, content={"error": http_err.detail})
     except Exception as e:
-        print(f"💥 Error grave en /agendar_cita: {e}")
-        traceback.print_exc()
-        return JSONResponse(status_code=500, content={"error": "internal_error", "detail": str(e)})
+        logger.exception("💥 Error grave en /agendar_cita: %s", e)
+        return ORJSONResponse(status_code=500, content={"error": "internal_error", "detail": str(e)})
 
 
 # =================================================================
@@ -474,16 +733,73 @@ async def agendar_cita_endpoint(request: Request):
 # Usamos el HMAC_SECRET como secreto del JWT, o uno nuevo si lo defines.
 AGENT_JWT_SECRET = os.getenv("AGENT_JWT_SECRET", HMAC_SECRET)
 JWT_ALGORITHM = "HS256"
+JWT_TTL_SECS = 12 * 3600  # Los tokens del panel expiran en 12 horas
 # Este endpoint '/agent/login' lo crearemos más abajo
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/agent/login")
 
 if not AGENT_JWT_SECRET:
     raise RuntimeError("❌ Falta AGENT_JWT_SECRET (o ELEVENLABS_HMAC_SECRET) para el login de agentes.")
 
+# --- JWT HS256 firmado con la plantilla HMAC ya inicializada (sin re-procesar la clave) ---
+def _b64url_encode(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+def _b64url_decode(data: bytes) -> bytes:
+    return base64.urlsafe_b64decode(data + b"=" * (-len(data) % 4))
+
+_JWT_HEADER_B64 = _b64url_encode(orjson.dumps({"alg": JWT_ALGORITHM, "typ": "JWT"}))
+
+def _jwt_encode(payload: Dict[str, Any]) -> str:
+    """
+    Firma el payload como JWT HS256 (compatible con los tokens emitidos por python-jose).
+    """
+    signing_input = _JWT_HEADER_B64 + b"." + _b64url_encode(orjson.dumps(payload))
+    signature = _hmac_digest(AGENT_JWT_SECRET, signing_input)
+    return (signing_input + b"." + _b64url_encode(signature)).decode("ascii")
+
+def _jwt_decode(token: str) -> Dict[str, Any]:
+    """
+    Verifica firma (tiempo constante), algoritmo y expiración del JWT y devuelve su payload.
+    Lanza JWTError si el token no es válido.
+    """
+    try:
+        signing_input, _, signature_b64 = token.encode("ascii").rpartition(b".")
+        header_b64, _, payload_b64 = signing_input.partition(b".")
+        header = orjson.loads(_b64url_decode(header_b64))
+        signature = _b64url_decode(signature_b64)
+    except ValueError:
+        raise JWTError("Token malformado")
+
+    if not isinstance(header, dict) or header.get("alg") != JWT_ALGORITHM:
+        raise JWTError("Algoritmo no permitido")
+    if not hmac.compare_digest(signature, _hmac_digest(AGENT_JWT_SECRET, signing_input)):
+        raise JWTError("Firma inválida")
+
+    try:
+        payload = orjson.loads(_b64url_decode(payload_b64))
+    except ValueError:
+        raise JWTError("Payload malformado")
+    if not isinstance(payload, dict):
+        raise JWTError("Payload malformado")
+
+    exp = payload.get("exp")
+    if exp is not None and (not isinstance(exp, (int, float)) or time.time() >= exp):
+        raise JWTError("Token expirado")
+
+    return payload
+
 # --- 2. Modelos de Datos (Pydantic) para FastAPI ---
 class AgentDataRequest(BaseModel):
-    start_date: str
-    end_date: str
+    # Fechas ISO (YYYY-MM-DD) validadas por Pydantic antes de entrar al handler
+    start_date: date
+    end_date: date
+
+    @model_validator(mode="after")
+    def _check_range(self) -> "AgentDataRequest":
+        # Un rango invertido no tiene sentido: se rechaza antes de consultar ElevenLabs
+        if self.end_date < self.start_date:
+            raise ValueError("end_date no puede ser anterior a start_date")
+        return self
 
 class Token(BaseModel):
     access_token: str
@@ -495,6 +811,12 @@ class AgentData(BaseModel):
 
 
 # --- 3. Dependencia de Autenticación (El "Guardia" de los Endpoints) ---
+# Tokens ya validados: token -> (válido_hasta, AgentData). El TTL corto acota cuánto
+# tarda en verse un cambio en la config del agente.
+AUTH_CACHE_TTL_SECS = 60
+AUTH_CACHE_MAX_ENTRIES = 4096
+_AUTH_CACHE: Dict[str, Tuple[float, AgentData]] = {}
+
 async def get_current_agent(token: str = Depends(oauth2_scheme)) -> AgentData:
     """
     Dependencia de FastAPI: Decodifica el token JWT, verifica que sea válido
@@ -505,23 +827,38 @@ async def get_current_agent(token: str = Depends(oauth2_scheme)) -> AgentData:
         detail="Credenciales inválidas",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    now = time.time()
+    cached = _AUTH_CACHE.get(token)
+    if cached and cached[0] > now:
+        return cached[1]
+
     try:
-        payload = jwt.decode(token, AGENT_JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        payload = _jwt_decode(token)
         bot_slug: str = payload.get("sub") # "sub" (subject) es el bot_slug
         if bot_slug is None:
             raise credentials_exception
 
-        # Volvemos a cargar la config del agente desde el slug (asegura datos frescos)
-        # Usamos la ruta de tu variable global BOT_CONFIG_DIR
-        bot_file_path = os.path.join(BOT_CONFIG_DIR, f"{bot_slug}.json")
-        if not os.path.exists(bot_file_path):
-            print(f"❌ Error de Token: No se encontró el archivo {bot_file_path} para el slug {bot_slug}")
+        # El slug debe existir en el índice en memoria (precargado al arrancar)
+        if bot_slug not in _BOT_SLUG_TO_CONFIG:
+            # Puede que se haya añadido el archivo después del arranque
+            await run_in_threadpool(_reload_agent_configs_if_changed)
+        if bot_slug not in _BOT_SLUG_TO_CONFIG:
+            logger.error("❌ Error de Token: No se encontró la config en %s para el slug %s", BOT_CONFIG_DIR, bot_slug)
             raise credentials_exception
 
-        with open(bot_file_path, 'r', encoding='utf-8') as f:
-            config_data = json.load(f)
+        # Datos frescos: sólo se vuelve a parsear si el archivo cambió (mtime)
+        bot_file_path = os.path.join(BOT_CONFIG_DIR, f"{bot_slug}.json")
+        try:
+            config_data = await run_in_threadpool(_load_config, bot_file_path)
+        except (OSError, ValueError) as e:
+            logger.error("❌ Error de Token: No se pudo leer %s para el slug %s: %s", bot_file_path, bot_slug, e)
+            raise credentials_exception
 
-        return AgentData(bot_slug=bot_slug, config=config_data)
+        agent = AgentData(bot_slug=bot_slug, config=config_data)
+        if len(_AUTH_CACHE) >= AUTH_CACHE_MAX_ENTRIES:
+            _AUTH_CACHE.clear()
+        _AUTH_CACHE[token] = (min(payload.get("exp") or float("inf"), now + AUTH_CACHE_TTL_SECS), agent)
+        return agent
 
     except JWTError:
         raise credentials_exception
@@ -531,15 +868,39 @@ async def get_current_agent(token: str = Depends(oauth2_scheme)) -> AgentData:
 # (Estos endpoints deben estar protegidos por tu autenticación de admin/bearer)
 # (¡IMPORTANTE! Debes añadir tu propia seguridad a estos dos endpoints)
 
+# Caché en memoria de las respuestas de ElevenLabs (cambian en escala de minutos/horas)
+SYNC_CACHE_TTL_SECS = 60
+SYNC_CACHE_MAX_ENTRIES = 1024
+_SYNC_CACHE: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+
+async def _cached(key: str, ttl: float, fn, refresh: bool = False) -> Dict[str, Any]:
+    """
+    Devuelve el resultado de fn() (ejecutado en el threadpool) cacheado durante ttl segundos.
+    Sólo se cachean respuestas correctas ({"ok": True, ...}).
+    """
+    now = time.monotonic()
+    hit = _SYNC_CACHE.get(key)
+    if hit and not refresh and hit[0] > now:
+        return hit[1]
+
+    result = await run_in_threadpool(fn)
+    if result.get("ok"):
+        # Las claves de consumo varían por rango de fechas: acotamos el tamaño
+        if len(_SYNC_CACHE) >= SYNC_CACHE_MAX_ENTRIES:
+            _SYNC_CACHE.clear()
+        _SYNC_CACHE[key] = (now + ttl, result)
+    return result
+
 @app.get("/admin/sync-agents")
 async def admin_sync_agents(
     # TODO: Añadir aquí tu dependencia de autenticación de admin
     # ej: admin_user: dict = Depends(get_current_admin_user)
+    refresh: bool = False,  # ?refresh=1 fuerza consultar ElevenLabs
 ):
     """
     Endpoint para que WordPress pida la lista de agentes de ElevenLabs.
     """
-    result = get_eleven_agents()
+    result = await _cached("agents", SYNC_CACHE_TTL_SECS, get_eleven_agents, refresh)
     if not result["ok"]:
         raise HTTPException(status_code=500, detail=result["error"])
 
@@ -557,16 +918,17 @@ async def admin_sync_agents(
             for a in result["data"] if isinstance(a, dict)
         ]
 
-    return JSONResponse(content={"ok": True, "data": agents_list})
+    return ORJSONResponse(content={"ok": True, "data": agents_list})
 
 @app.get("/admin/sync-numbers")
 async def admin_sync_numbers(
     # TODO: Añadir aquí tu dependencia de autenticación de admin
+    refresh: bool = False,  # ?refresh=1 fuerza consultar ElevenLabs
 ):
     """
     Endpoint para que WordPress pida la lista de números de ElevenLabs.
     """
-    result = get_eleven_phone_numbers()
+    result = await _cached("phone_numbers", SYNC_CACHE_TTL_SECS, get_eleven_phone_numbers, refresh)
     if not result["ok"]:
         raise HTTPException(status_code=500, detail=result["error"])
 
@@ -580,7 +942,7 @@ async def admin_sync_numbers(
         phone_numbers_data = result["data"]
     else:
         # Si la estructura no es la esperada, devolver lista vacía o error
-        print(f"⚠️ Estructura inesperada en respuesta de /v1/convai/phone-numbers: {result.get('data')}")
+        logger.warning("⚠️ Estructura inesperada en respuesta de /v1/convai/phone-numbers: %s", result.get('data'))
         phone_numbers_data = [] # O podrías lanzar una HTTPException aquí
 
     # Iterar sobre la lista de números encontrada
@@ -592,13 +954,65 @@ async def admin_sync_numbers(
                 "phone_number": n.get("phone_number")
             })
 
-    return JSONResponse(content={"ok": True, "data": numbers_list})
+    return ORJSONResponse(content={"ok": True, "data": numbers_list})
 
 
 # --- 5. Endpoints del Panel Agentes (Cliente) ---
 
-@app.post("/agent/login", response_model=Token)
-async def agent_login(form_data: OAuth2PasswordRequestForm = Depends()):
+# Límite de intentos fallidos de login por (usuario, IP): cada intento cuesta un bcrypt
+# completo. El contador vive en memoria, así que el límite es POR WORKER: con N workers
+# de gunicorn el máximo real es LOGIN_RATE_LIMIT × N por ventana.
+LOGIN_RATE_LIMIT = 5
+LOGIN_RATE_WINDOW_SECS = 60
+_LOGIN_ATTEMPTS: Dict[Tuple[str, str], List[float]] = {}
+# Coste máximo de bcrypt aceptado en los hashes (cada +1 duplica el tiempo de CPU)
+MAX_BCRYPT_COST = int(os.getenv("AGENT_MAX_BCRYPT_COST", "12") or 12)
+
+def _login_rate_limited(key: Tuple[str, str]) -> bool:
+    """
+    Registra un intento de login y devuelve True si se superó el límite de la ventana.
+    El intento se cuenta de entrada (así los intentos en curso también cuentan) y se
+    descarta si el login resulta correcto: sólo los fallos agotan el límite.
+    """
+    now = time.monotonic()
+    if len(_LOGIN_ATTEMPTS) > 1024:
+        # Limpieza de claves sin intentos recientes
+        for k in [k for k, v in _LOGIN_ATTEMPTS.items() if now - v[-1] >= LOGIN_RATE_WINDOW_SECS]:
+            del _LOGIN_ATTEMPTS[k]
+
+    attempts = [t for t in _LOGIN_ATTEMPTS.get(key, ()) if now - t < LOGIN_RATE_WINDOW_SECS]
+    limited = len(attempts) >= LOGIN_RATE_LIMIT
+    if not limited:
+        attempts.append(now)
+    _LOGIN_ATTEMPTS[key] = attempts
+    return limited
+
+# Proxies de confianza delante de la app (Render: 1). Cada uno añade una entrada al final
+# de X-Forwarded-For; con 0 se usa la IP del socket (despliegue sin proxy).
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "1") or 0)
+
+def _client_ip(request: Request) -> str:
+    """
+    IP real del cliente para el rate limit de login. Detrás del proxy, request.client es la
+    IP del proxy; se toma la entrada de X-Forwarded-For que añadió el último proxy de
+    confianza (las de la izquierda las puede inventar el cliente y se ignoran).
+    """
+    if TRUSTED_PROXY_HOPS:
+        hops = [h.strip() for h in request.headers.get("x-forwarded-for", "").split(",") if h.strip()]
+        if len(hops) >= TRUSTED_PROXY_HOPS:
+            return hops[-TRUSTED_PROXY_HOPS]
+    return request.client.host if request.client else ""
+
+def _bcrypt_cost(stored_hash: bytes) -> Optional[int]:
+    """Extrae el factor de coste de un hash bcrypt ($2b$12$...)."""
+    try:
+        return int(stored_hash.split(b"$")[2])
+    except (IndexError, ValueError):
+        return None
+
+# Sin response_model: devolvemos la respuesta ya serializada (Token sólo documenta el esquema)
+@app.post("/agent/login", responses={200: {"model": Token}})
+async def agent_login(request: Request, form_data: OAuth2PasswordRequestForm = Depends()):
     """
     Endpoint de login para el shortcode [panel_agentes].
     Usa el formato OAuth2 (username, password) que espera FastAPI.
@@ -606,41 +1020,71 @@ async def agent_login(form_data: OAuth2PasswordRequestForm = Depends()):
     username = form_data.username
     password = form_data.password
 
+    client_ip = _client_ip(request)
+    if _login_rate_limited((username, client_ip)):
+        logger.warning("Login bloqueado: demasiados intentos para '%s' desde %s.", username, client_ip)
+        raise HTTPException(status_code=429, detail="Demasiados intentos, inténtalo más tarde")
+
     # 1. Buscar al agente por su 'agent_user' usando nuestro nuevo helper
-    agent_config = map_username_to_agent_data(username)
+    agent_config = (
+        AGENT_USERNAME_TO_CONFIG_CACHE.get(username)
+        or await run_in_threadpool(map_username_to_agent_data, username)
+    )
 
     if not agent_config:
-        print(f"Login fallido: Usuario '{username}' no encontrado.")
+        logger.warning("Login fallido: Usuario '%s' no encontrado.", username)
         raise HTTPException(status_code=401, detail="Credenciales inválidas")
 
     # 2. Verificar la contraseña
     # (El 'agent_pass_hash' lo creará WordPress)
     stored_hash = agent_config.get('agent_pass_hash', '').encode('utf-8')
 
+    cost = _bcrypt_cost(stored_hash)
+    if cost is not None and cost > MAX_BCRYPT_COST:
+        logger.warning("Login fallido: coste bcrypt %s > %s para '%s'.", cost, MAX_BCRYPT_COST, username)
+        raise HTTPException(status_code=500, detail="Error de configuración de cuenta")
+
     try:
         # Usamos bcrypt para comparar el password con el hash
-        if not bcrypt.checkpw(password.encode('utf-8'), stored_hash):
-            print(f"Login fallido: Contraseña incorrecta para '{username}'.")
+        if not await run_in_threadpool(bcrypt.checkpw, password.encode('utf-8'), stored_hash):
+            logger.warning("Login fallido: Contraseña incorrecta para '%s'.", username)
             raise HTTPException(status_code=401, detail="Credenciales inválidas")
     except ValueError:
-        print(f"Login fallido: Hash de contraseña inválido o vacío para '{username}'.")
+        logger.warning("Login fallido: Hash de contraseña inválido o vacío para '%s'.", username)
         raise HTTPException(status_code=500, detail="Error de configuración de cuenta")
 
     # 3. ¡Éxito! Crear y devolver un token
     bot_slug = agent_config["_bot_slug"] # El nombre de archivo (ej. 'sundin')
 
     # Creamos el token JWT
+    now = int(time.time())
     payload = {
         "sub": bot_slug, # 'sub' (subject) es el estándar para el ID de usuario
-        "iat": int(time.time()),
-        "exp": int(time.time()) + (12 * 3600)  # Expira en 12 horas
+        "iat": now,
+        "exp": now + JWT_TTL_SECS
     }
-    access_token = jwt.encode(payload, AGENT_JWT_SECRET, algorithm=JWT_ALGORITHM)
+    access_token = _jwt_encode(payload)
+
+    # Login correcto: se olvidan los intentos previos de este (usuario, IP)
+    _LOGIN_ATTEMPTS.pop((username, client_ip), None)
 
-    print(f"Login exitoso para: {username} (slug: {bot_slug})")
-    return {"access_token": access_token, "token_type": "bearer"}
+    logger.info("Login exitoso para: %s (slug: %s)", username, bot_slug)
+    return ORJSONResponse(content={"access_token": access_token, "token_type": "bearer"})
 
 
+# Costo por crédito de ElevenLabs (se lee una sola vez desde .env)
+try:
+    USD_PER_CREDIT = float(os.getenv("ELEVENLABS_USD_PER_CREDIT", "0.0001") or "0.0001")
+except ValueError:
+    USD_PER_CREDIT = 0.0001
+
+@lru_cache(maxsize=256)
+def _day_start_unix(day: date) -> int:
+    """
+    Convierte una fecha al timestamp Unix (UTC) del inicio de ese día.
+    """
+    return calendar.timegm(day.timetuple())
+
 @app.post("/agent/data")
 async def get_agent_data(
     request: AgentDataRequest,
@@ -662,17 +1106,18 @@ async def get_agent_data(
     if not agent_id:
         raise HTTPException(status_code=400, detail="Agente no configurado para ElevenLabs")
 
-    # 2. Convertir fechas a Unix
-    try:
-        start_unix = int(time.mktime(datetime.strptime(request.start_date, '%Y-%m-%d').timetuple()))
-        # Aseguramos que la fecha final sea al final del día (23:59:59)
-        end_dt = datetime.strptime(request.end_date, '%Y-%m-%d') + timedelta(days=1, seconds=-1)
-        end_unix = int(time.mktime(end_dt.timetuple()))
-    except ValueError:
-        raise HTTPException(status_code=400, detail="Formato de fecha inválido, usar YYYY-MM-DD")
+    # 2. Convertir fechas a Unix (Pydantic ya validó el formato YYYY-MM-DD)
+    start_unix = _day_start_unix(request.start_date)
+    # Aseguramos que la fecha final sea al final del día (23:59:59)
+    end_unix = _day_start_unix(request.end_date) + 86400 - 1
 
     # 3. Consultar la API de consumo
-    result = get_agent_consumption_data(agent_id, start_unix, end_unix)
+    # El panel recarga los mismos rangos a menudo: se reutiliza el caché de 60 s de /admin
+    result = await _cached(
+        f"consumption:{agent_id}:{start_unix}:{end_unix}",
+        SYNC_CACHE_TTL_SECS,
+        lambda: get_agent_consumption_data(agent_id, start_unix, end_unix),
+    )
 
     if not result["ok"]:
         # Si no hay datos (ej. agente no encontrado en reporte), devolvemos ceros
@@ -687,14 +1132,7 @@ async def get_agent_data(
         }
 
     # 4. Devolver el JSON final
-    # (¡IMPORTANTE! Debes añadir tu lógica de 'costo por crédito' aquí)
-    # Por ahora usamos un valor fijo, pero deberías cargarlo desde .env
-    try:
-        usd_per_credit = float(os.getenv("ELEVENLABS_USD_PER_CREDIT", "0.0001"))
-    except:
-        usd_per_credit = 0.0001
-
-    total_cost_usd = consumption_data["credits"] * usd_per_credit
+    total_cost_usd = consumption_data["credits"] * USD_PER_CREDIT
 
     final_data = {
         "agent_name": agent_name,
@@ -703,7 +1141,175 @@ async def get_agent_data(
         "credits_consumed": consumption_data["credits"],
         "total_cost_usd": total_cost_usd
     }
-    return JSONResponse(content={"ok": True, "data": final_data})
+    return ORJSONResponse(content={"ok": True, "data": final_data})
+
+
+# Tamaño máximo del archivo de destinatarios
+MAX_UPLOAD_BYTES = int(os.getenv("BATCH_MAX_UPLOAD_BYTES") or 10 * 1024 * 1024)
+
+# Regex de normalización de cabeceras (compiladas una sola vez)
+_COL_PUNCT_RE = re.compile(r"[^\w\s]")
+_COL_WS_RE = re.compile(r"\s+")
+_PHONE_COLUMN_CANDIDATES = ("telefono", "teléfono", "numero", "número", "phone", "celular")
+_LAST_NAME_KEYS = frozenset(("lastname", "apellidos", "apellido"))
+_PHONE_KEY_RE = re.compile(r"[^\d+]")
+
+def _normalize_column(col: Any) -> str:
+    """Normaliza una cabecera: quita signos, espacios -> '_', minúsculas."""
+    return _COL_WS_RE.sub("_", _COL_PUNCT_RE.sub("", str(col if col is not None else ""))).lower()
+
+def _sniff_format(head: bytes) -> str:
+    """Detecta el formato por los primeros bytes: ZIP -> xlsx, OLE2 -> xls, resto -> csv."""
+    if head.startswith(b"PK\x03\x04"):
+        return "xlsx"
+    if head.startswith(b"\xd0\xcf\x11\xe0"):
+        return "xls"
+    return "csv"
+
+# Codificación de respaldo: Excel en Windows exporta los CSV en cp1252
+_CSV_FALLBACK_ENCODING = "cp1252"
+
+def _detect_csv_encoding(fileobj: BinaryIO) -> str:
+    """
+    Devuelve "utf-8-sig" si todo el archivo es UTF-8 válido y, si no, la de respaldo.
+    Valida por bloques (sin cargar el archivo en memoria) y deja el cursor al inicio.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    try:
+        for chunk in iter(lambda: fileobj.read(64 * 1024), b""):
+            decoder.decode(chunk)
+        decoder.decode(b"", final=True)
+        return "utf-8-sig"
+    except UnicodeDecodeError:
+        return _CSV_FALLBACK_ENCODING
+    finally:
+        fileobj.seek(0)
+
+def _iter_csv_rows(fileobj: BinaryIO) -> Iterator[List[Any]]:
+    """Filas del CSV (la primera es la cabecera), leídas en streaming con el módulo csv."""
+    encoding = _detect_csv_encoding(fileobj)
+    # UTF-8 estricto; en cp1252 "replace" sólo cubre los 5 bytes que no tienen carácter asignado
+    errors = "strict" if encoding == "utf-8-sig" else "replace"
+    text = io.TextIOWrapper(fileobj, encoding=encoding, errors=errors, newline="")
+    try:
+        yield from csv.reader(text)
+    finally:
+        # Soltamos el archivo sin cerrarlo (lo cierra FastAPI al terminar la petición)
+        text.detach()
+
+def _iter_xlsx_rows(fileobj: BinaryIO) -> Iterator[Tuple[Any, ...]]:
+    """Filas de la hoja activa del .xlsx con openpyxl en modo sólo lectura."""
+    from openpyxl import load_workbook
+    wb = load_workbook(fileobj, read_only=True, data_only=True)
+    try:
+        yield from wb.active.iter_rows(values_only=True)
+    finally:
+        wb.close()
+
+def _iter_xls_rows(fileobj: BinaryIO) -> Iterator[Tuple[Any, ...]]:
+    """Filas de un .xls antiguo (openpyxl no lo soporta): pandas sólo se importa aquí."""
+    import pandas as pd
+    # dtype=str + na_filter=False: sin conversión posterior ni escaneo de NaN
+    df = pd.read_excel(fileobj, header=None, dtype=str, keep_default_na=False, na_filter=False)
+    yield from df.itertuples(index=False, name=None)
+
+def _parse_recipients(fileobj: BinaryIO, filename: str) -> List[Dict[str, Any]]:
+    """
+    Parsea el archivo subido (.csv, .xls, .xlsx) fila por fila directamente desde el
+    archivo temporal del upload y devuelve la lista de destinatarios.
+    Es bloqueante: se ejecuta en el threadpool.
+    """
+    recipients: List[Dict[str, Any]] = []
+
+    # Tamaño real del upload (el archivo temporal ya está escrito, en memoria o en disco)
+    fileobj.seek(0, os.SEEK_END)
+    if fileobj.tell() > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"Archivo demasiado grande (máx. {MAX_UPLOAD_BYTES} bytes)")
+    fileobj.seek(0)
+
+    # Parse según el contenido real (firma mágica), no sólo la extensión
+    file_format = _sniff_format(fileobj.read(4))
+    fileobj.seek(0)
+    if not filename.endswith(f".{file_format}"):
+        logger.warning("⚠️ La extensión de '%s' no coincide con su contenido (%s).", filename, file_format)
+
+    if file_format == "csv":
+        rows = _iter_csv_rows(fileobj)
+    elif file_format == "xlsx":
+        rows = _iter_xlsx_rows(fileobj)
+    else:
+        rows = _iter_xls_rows(fileobj)
+
+    # El generador se cierra siempre (también si salimos con un 400): así se suelta
+    # el archivo/workbook antes de que FastAPI cierre el upload
+    try:
+        header = next(rows, None) or []
+
+        # Normalizar headers una sola vez: quitar signos, espacios->_, minúsculas
+        columns = [_normalize_column(col) for col in header]
+
+        # Buscar/renombrar columna de teléfono
+        if "phone_number" not in columns:
+            for cand in _PHONE_COLUMN_CANDIDATES:
+                if cand in columns:
+                    columns[columns.index(cand)] = "phone_number"
+                    break
+
+        if "phone_number" not in columns:
+            raise HTTPException(status_code=400, detail="El archivo debe contener una columna 'phone_number' (o similar)")
+
+        phone_idx = columns.index("phone_number")
+
+        # Mapa precalculado (índice de columna -> clave de salida):
+        # mantener name/last_name y pasar el resto como variables dinámicas
+        col_map: List[Tuple[int, str]] = []
+        for idx, col in enumerate(columns):
+            if col == "phone_number":
+                continue
+            key_clean = col.replace("_", "")
+            if key_clean == "name":
+                col_map.append((idx, "name"))
+            elif key_clean in _LAST_NAME_KEYS:
+                col_map.append((idx, "last_name"))
+            else:
+                col_map.append((idx, key_clean))
+
+        n_cols = len(columns)
+        seen_phones = set()
+        duplicates = 0
+        for values in rows:
+            if len(values) < n_cols:
+                # Filas más cortas que la cabecera
+                values = tuple(values) + (None,) * (n_cols - len(values))
+
+            phone = values[phone_idx]
+            phone = str(phone).strip() if phone is not None else ""
+            if not phone:
+                continue
+
+            # Deduplicar por el número normalizado (sólo dígitos y '+'). Los valores sin
+            # dígitos (p. ej. "N/A") no se descartan: llegan a start_batch_call y aparecen
+            # en su reporte de fallos
+            phone_key = _PHONE_KEY_RE.sub("", phone)
+            if phone_key:
+                if phone_key in seen_phones:
+                    duplicates += 1
+                    continue
+                seen_phones.add(phone_key)
+
+            item: Dict[str, Any] = {"phone_number": phone}
+            for idx, key in col_map:
+                v = values[idx]
+                # Asegurar strings y sin None (celdas vacías)
+                item[key] = str(v).strip() if v is not None else ""
+
+            recipients.append(item)
+    finally:
+        rows.close()
+
+    if duplicates:
+        logger.warning("⚠️ Se omitieron %s filas con teléfono duplicado.", duplicates)
+    return recipients
 
 
 @app.post("/agent/start-batch-call")
@@ -715,7 +1321,7 @@ async def handle_batch_call(
     """
     Endpoint seguro para iniciar un lote de llamadas.
     Recibe un formulario 'multipart/form-data'.
-    Soporta .csv, .xls y .xlsx (con pandas).
+    Soporta .csv (módulo csv), .xlsx (openpyxl) y .xls (pandas).
     Normaliza cabeceras y permite variables dinámicas (name, last_name, etc.).
     """
     bot_config = agent.config
@@ -741,77 +1347,27 @@ async def handle_batch_call(
     if not agent_id or not phone_number_id:
         raise HTTPException(status_code=400, detail="Faltan elevenlabs_agent_id o elevenlabs_phone_number_id en la config")
 
-    recipients: List[Dict[str, Any]] = []
-
     try:
-        # Leemos todo el archivo a memoria
-        content = await csv_file.read()
-        file_like = io.BytesIO(content)
-
-        # Parse segun extensión
-        if filename.endswith(".csv"):
-            # Usamos pandas también para CSV para tener la misma normalización
-            df = pd.read_csv(file_like)
-        else:
-            df = pd.read_excel(file_like)
-
-        # Normalizar headers: quitar signos, espacios->_, minúsculas
-        df.columns = [
-            re.sub(r"\s+", "_", re.sub(r"[^\w\s]", "", str(col))).lower()
-            for col in df.columns
-        ]
-
-        # Buscar/renombrar columna de teléfono
-        if "phone_number" not in df.columns:
-            for cand in ["telefono", "teléfono", "numero", "número", "phone", "celular"]:
-                if cand in df.columns:
-                    df.rename(columns={cand: "phone_number"}, inplace=True)
-                    break
-
-        if "phone_number" not in df.columns:
-            raise HTTPException(status_code=400, detail="El archivo debe contener una columna 'phone_number' (o similar)")
-
-        # Asegurar strings y sin NaN
-        df = df.astype(str).fillna("")
-        rows = df.to_dict(orient="records")
-
-        for row in rows:
-            phone = (row.get("phone_number") or "").strip()
-            if not phone:
-                continue
-
-            item: Dict[str, Any] = {"phone_number": phone}
-
-            # Mantener name/last_name y pasar el resto como variables dinámicas
-            for k, v in row.items():
-                if k == "phone_number":
-                    continue
-                key_clean = k.replace("_", "").lower()
-                if key_clean == "name":
-                    item["name"] = str(v).strip()
-                elif key_clean in ("lastname", "apellidos", "apellido"):
-                    item["last_name"] = str(v).strip()
-                else:
-                    item[key_clean] = str(v).strip()
-
-            recipients.append(item)
-
+        # Leemos fila a fila desde el archivo temporal (SpooledTemporaryFile), sin
+        # cargarlo entero en memoria. El parseo es bloqueante: lo sacamos del event loop
+        recipients = await run_in_threadpool(_parse_recipients, csv_file.file, filename)
     except HTTPException:
         raise
     except Exception as e:
-        traceback.print_exc()
+        logger.exception("💥 Error procesando el archivo del lote: %s", e)
         raise HTTPException(status_code=400, detail=f"Error procesando el archivo: {e}")
 
     if not recipients:
         raise HTTPException(status_code=400, detail="El archivo no contiene destinatarios válidos")
 
-    print(f"Iniciando lote para {agent.bot_slug} (Agente ID: {agent_id})")
-    print(f"DEBUG outbound sample -> {recipients[0] if recipients else None}")
+    logger.info("Iniciando lote para %s (Agente ID: %s)", agent.bot_slug, agent_id)
+    logger.debug("outbound sample -> %s", recipients[0] if recipients else None)
 
     # 3. Enviar la petición a ElevenLabs (compatibilidad de firma)
     try:
         # Firma usada en tu segundo código
-        result = start_batch_call(
+        result = await run_in_threadpool(
+            start_batch_call,
             call_name=batch_name,
             agent_id=agent_id,
             phone_number_id=phone_number_id,
@@ -819,12 +1375,12 @@ async def handle_batch_call(
         )
     except TypeError:
         # Firma usada en tu primer código (posicional)
-        result = start_batch_call(batch_name, agent_id, phone_number_id, recipients)
+        result = await run_in_threadpool(start_batch_call, batch_name, agent_id, phone_number_id, recipients)
 
     if not result.get("ok"):
         raise HTTPException(status_code=500, detail=result.get("error", "Error desconocido"))
 
-    return JSONResponse(content={"ok": True, "data": result["data"]})
+    return ORJSONResponse(content={"ok": True, "data": result["data"]})
 
 # =================================================================
 # === FIN: LÓGICA DEL PANEL AGENTES ===============================
@@ -12,10 +12,11 @@ JWT_ALGORITHM = "HS256"
 
 def create_agent_token(bot_slug):
     """Crea un nuevo token JWT para un agente."""
+    now = int(time.time())
     payload = {
         "bot_slug": bot_slug,
-        "iat": int(time.time()),
-        "exp": int(time.time()) + (12 * 3600)  # Expira en 12 horas
+        "iat": now,
+        "exp": now + (12 * 3600)  # Expira en 12 horas
     }
     token = jwt.encode(payload, JWT_SECRET_KEY, algorithm=JWT_ALGORITHM)
     return token
@@ -0,0 +1,18 @@
+# gunicorn.conf.py
+# Configuración de producción: Gunicorn gestiona varios workers de Uvicorn
+# (uvloop + httptools se seleccionan automáticamente al estar instalados).
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '10000')}"
+worker_class = "uvicorn.workers.UvicornWorker"
+# Número fijo y pequeño por defecto: cpu_count() ve las CPUs del host, no el límite del
+# contenedor, y cada worker tiene sus propios cachés, circuit breakers, rate limiter de
+# login y cliente de Twilio. Se ajusta con WEB_CONCURRENCY.
+workers = int(os.getenv("WEB_CONCURRENCY") or 2)
+
+# Sin access log (Render ya registra las peticiones en su proxy)
+accesslog = None
+
+# forwarded_allow_ips se deja por defecto a propósito: con "*" uvicorn tomaría la primera
+# IP de X-Forwarded-For, que controla el cliente. La IP real para el rate limit de login
+# se obtiene en la app (TRUSTED_PROXY_HOPS en api/main.py).
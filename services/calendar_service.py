@@ -1,12 +1,42 @@
 import requests
 import json
+import orjson
 import os 
+
+from services.resilience import CircuitBreaker, CircuitOpenError, retry_call
 # Nota: La librería 'requests' debe estar instalada (pip install requests)
 
 # 1. *** CONFIGURACIÓN CRUCIAL: URL DE LA IMPLEMENTACIÓN 'VERSIÓN 11' (FINAL) ***
 # Esta URL apunta a la última implementación con la corrección de fecha/hora.
 WEBHOOK_URL = 'https://script.google.com/macros/s/AKfycbxbtKar4yyzWkD6DVnuf7bgG4SnuYsNZthOZFqVbOByIyF3P20iLI85wFfVns5zZVSDBA/exec'
 
+DEFAULT_TIMEOUT = 30
+# Respuestas de pasarela (el Apps Script no llegó a procesar la petición): seguras de reintentar
+RETRY_STATUSES = (502, 503, 504)
+# Tras 5 fallos seguidos dejamos de llamar al Apps Script durante 30 s
+APPS_SCRIPT_BREAKER = CircuitBreaker("apps_script", fail_max=5, reset_timeout=30.0)
+
+def _is_retryable(exc: BaseException) -> bool:
+    """
+    Sólo reintentamos si la petición no llegó a procesarse (error de conexión o 502/503/504):
+    agendar no es idempotente y un reintento tras un timeout de lectura podría duplicar la cita.
+    """
+    if isinstance(exc, requests.exceptions.ConnectionError):
+        return True
+    response = getattr(exc, "response", None)
+    return isinstance(exc, requests.exceptions.HTTPError) and response is not None and response.status_code in RETRY_STATUSES
+
+def _post_webhook(datos_cliente):
+    response = requests.post(
+        WEBHOOK_URL,
+        headers={'Content-Type': 'application/json'},
+        data=orjson.dumps(datos_cliente),
+        timeout=DEFAULT_TIMEOUT
+    )
+    if response.status_code in RETRY_STATUSES:
+        response.raise_for_status()
+    return response
+
 # --- FUNCIÓN PRINCIPAL DE AGENDAMIENTO ---
 def book_appointment(nombre, apellido, telefono, email, fechaCita, horaCita):
     """
@@ -29,11 +59,8 @@ def book_appointment(nombre, apellido, telefono, email, fechaCita, horaCita):
     
     # 3. Envía la solicitud POST al Webhook
     try:
-        response = requests.post(
-            WEBHOOK_URL,
-            headers={'Content-Type': 'application/json'},
-            data=json.dumps(datos_cliente)
-        )
+        # Reintentos con backoff + jitter, a través del circuit breaker
+        response = APPS_SCRIPT_BREAKER.call(retry_call, _post_webhook, datos_cliente, retry_if=_is_retryable)
 
         response.raise_for_status() # Lanza error si hay un problema HTTP
         
@@ -48,6 +75,9 @@ def book_appointment(nombre, apellido, telefono, email, fechaCita, horaCita):
             
         return resultado
         
+    except CircuitOpenError as e:
+        print(f"❌ Apps Script no disponible (circuito abierto): {e}")
+        return {"status": "error", "message": str(e)}
     except requests.exceptions.RequestException as e:
         print(f"❌ ERROR CRÍTICO de conexión o HTTP: {e}")
         return {"status": "error", "message": str(e)}
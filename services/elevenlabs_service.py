@@ -1,9 +1,12 @@
 # services/elevenlabs_service.py
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, List, Optional, Tuple
 import requests
 
+from services.resilience import CircuitBreaker, backoff_delay
+
 # =========================
 # Config básica
 # =========================
@@ -17,9 +20,22 @@ RETRY_BACKOFF   = 1.5
 # Ejemplo (de tus números): 286 créditos / 35 s = 8.1714286
 CREDITS_PER_SEC = float(os.getenv("ELEVENLABS_CREDITS_PER_SEC", "0") or 0)
 
+# Pausa entre llamadas de un lote (segundos)
+BATCH_SLEEP_SECS = float(os.getenv("ELEVENLABS_BATCH_SLEEP", "0.0") or 0)
+
+# Llamadas de un lote en paralelo (1 = secuencial). Cada worker respeta BATCH_SLEEP_SECS,
+# así que el ritmo total hacia ElevenLabs se multiplica por este valor.
+BATCH_CONCURRENCY = max(1, int(os.getenv("ELEVENLABS_BATCH_CONCURRENCY", "1") or 1))
+
 # =========================
 # Helpers HTTP
 # =========================
+# Sesión compartida: reutiliza conexiones TLS (keep-alive) entre llamadas.
+# Las funciones de este módulo son síncronas; api/main.py las ejecuta en el threadpool.
+_session = requests.Session()
+# Tras 5 fallos seguidos (red o 5xx) dejamos de llamar a ElevenLabs durante 30 s
+_breaker = CircuitBreaker("elevenlabs", fail_max=5, reset_timeout=30.0)
+
 def _auth_headers(extra: Optional[Dict[str, str]] = None) -> Dict[str, str]:
     if not XI_API_KEY:
         raise RuntimeError("XI_API_KEY / ELEVENLABS_API_KEY no está configurada.")
@@ -33,16 +49,30 @@ def _auth_headers(extra: Optional[Dict[str, str]] = None) -> Dict[str, str]:
     return headers
 
 def _http(method: str, url: str, json_body: Optional[Dict[str, Any]] = None,
-          timeout: int = DEFAULT_TIMEOUT) -> Tuple[int, Any, Optional[str]]:
+          timeout: int = DEFAULT_TIMEOUT, use_breaker: bool = True) -> Tuple[int, Any, Optional[str]]:
+    """
+    use_breaker=False: la llamada ni consulta ni alimenta el circuit breaker (lotes, que
+    ya reintentan con backoff por destinatario).
+    """
+    if use_breaker and _breaker.is_open:
+        return 0, None, "circuit open: ElevenLabs no disponible temporalmente"
     try:
-        resp = requests.request(method=method, url=url, json=json_body,
+        resp = _session.request(method=method, url=url, json=json_body,
                                 headers=_auth_headers(), timeout=timeout)
         ct = (resp.headers.get("Content-Type") or "").lower()
         data = resp.json() if "application/json" in ct else resp.text
-        return resp.status_code, data, None
     except requests.RequestException as e:
+        if use_breaker:
+            _breaker.record_failure()
         return 0, None, str(e)
 
+    if use_breaker:
+        if resp.status_code >= 500:
+            _breaker.record_failure()
+        else:
+            _breaker.record_success()
+    return resp.status_code, data, None
+
 def _retryable(status: int) -> bool:
     return status == 429 or 500 <= status < 600
 
@@ -214,35 +244,34 @@ def _post_outbound_call(agent_id: str, phone_number_id: str, to_number: str,
         }
     }
 
-    delay = 1.0
+    # Fuera del circuit breaker: un corte breve no debe marcar como fallido al resto
+    # del lote sin reintentarlo; cada destinatario conserva sus reintentos con backoff
     for attempt in range(1, MAX_RETRIES + 1):
-        status, data, err = _http("POST", url, payload)
+        status, data, err = _http("POST", url, payload, use_breaker=False)
         if err:
             if attempt >= MAX_RETRIES:
                 return False, None, f"HTTP error: {err}", 0
-            time.sleep(delay); delay *= RETRY_BACKOFF; continue
+            time.sleep(backoff_delay(attempt, base=1.0, factor=RETRY_BACKOFF, max_delay=10.0)); continue
         if 200 <= status < 300:
             return True, (data if isinstance(data, dict) else {"raw": data}), None, status
         if _retryable(status):
             if attempt >= MAX_RETRIES:
                 return False, data, f"ElevenLabs error {status}: {data}", status
-            time.sleep(delay); delay *= RETRY_BACKOFF; continue
+            time.sleep(backoff_delay(attempt, base=1.0, factor=RETRY_BACKOFF, max_delay=10.0)); continue
         return False, data, f"ElevenLabs error {status}: {data}", status
 
     return False, None, "Unknown error", 0
 
-def start_batch_call(call_name: str, agent_id: str, phone_number_id: str,
-                     recipients_json: List[Dict[str, Any]]) -> Dict[str, Any]:
-    if not isinstance(recipients_json, list):
-        return {"ok": False, "error": "Parámetro recipients_json debe ser lista."}
-    if not agent_id or not phone_number_id:
-        return {"ok": False, "error": "Faltan agent_id o phone_number_id."}
-
-    total = len(recipients_json); sent = 0; failed = 0
+def _run_batch_slice(agent_id: str, phone_number_id: str,
+                     recipients: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Lanza secuencialmente las llamadas de una porción del lote (con la pausa entre llamadas).
+    """
+    total = len(recipients); sent = 0; failed = 0
     failures: List[Dict[str, Any]] = []; responses_sample: List[Any] = []
-    per_call_sleep = float(os.getenv("ELEVENLABS_BATCH_SLEEP", "0.0"))
+    per_call_sleep = BATCH_SLEEP_SECS
 
-    for idx, r in enumerate(recipients_json, start=1):
+    for idx, r in enumerate(recipients, start=1):
         to = str(r.get("phone_number","")).strip()
         if not to:
             failed += 1
@@ -267,14 +296,40 @@ def start_batch_call(call_name: str, agent_id: str, phone_number_id: str,
         if per_call_sleep and idx < total:
             time.sleep(per_call_sleep)
 
+    return {"sent": sent, "failed": failed, "failures": failures, "responses_sample": responses_sample}
+
+def start_batch_call(call_name: str, agent_id: str, phone_number_id: str,
+                     recipients_json: List[Dict[str, Any]]) -> Dict[str, Any]:
+    if not isinstance(recipients_json, list):
+        return {"ok": False, "error": "Parámetro recipients_json debe ser lista."}
+    if not agent_id or not phone_number_id:
+        return {"ok": False, "error": "Faltan agent_id o phone_number_id."}
+
+    total = len(recipients_json)
+    workers = min(BATCH_CONCURRENCY, total) or 1
+    if workers == 1:
+        parts = [_run_batch_slice(agent_id, phone_number_id, recipients_json)]
+    else:
+        # Reparto intercalado: cada worker mantiene su propia pausa entre llamadas
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(
+                lambda k: _run_batch_slice(agent_id, phone_number_id, recipients_json[k::workers]),
+                range(workers),
+            ))
+
+    failures: List[Dict[str, Any]] = []; responses_sample: List[Any] = []
+    for part in parts:
+        failures.extend(part["failures"])
+        responses_sample.extend(part["responses_sample"])
+
     return {
         "ok": True,
         "data": {
             "batch_name": call_name,
             "total": total,
-            "sent": sent,
-            "failed": failed,
+            "sent": sum(part["sent"] for part in parts),
+            "failed": sum(part["failed"] for part in parts),
             "failures": failures,
-            "responses_sample": responses_sample
+            "responses_sample": responses_sample[:3]
         }
     }
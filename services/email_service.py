@@ -1,7 +1,7 @@
 # services/email_service.py
 import os
 import re
-import json
+import orjson
 import smtplib
 import requests
 from typing import Dict, Any, List, Optional, Tuple
@@ -33,10 +33,12 @@ SENDER_EMAIL = os.getenv("SENDER_EMAIL", SMTP_USER)  # compat
 # =========================
 # Utils
 # =========================
+EMAIL_RE = re.compile(r'[\w\.-]+@[\w\.-]+\.\w+')
+
 def extract_email_from_text(text: str) -> Optional[str]:
     if not text:
         return None
-    m = re.search(r'[\w\.-]+@[\w\.-]+\.\w+', text)
+    m = EMAIL_RE.search(text)
     return m.group(0).lower() if m else None
 
 def get_agent_address(agent_slug: str) -> Optional[str]:
@@ -45,8 +47,8 @@ def get_agent_address(agent_slug: str) -> Optional[str]:
         if not os.path.exists(agent_path):
             print(f"⚠️ No se encontró {agent_path}")
             return None
-        with open(agent_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        with open(agent_path, "rb") as f:
+            data = orjson.loads(f.read())
         loc = data.get("location", {}) or {}
         return loc.get("maps_url") or loc.get("address")
     except Exception as e:
@@ -0,0 +1,98 @@
+# services/resilience.py
+import random
+import threading
+import time
+from typing import Any, Callable, Optional
+import requests
+
+# =========================
+# Reintentos con backoff exponencial + jitter
+# =========================
+def backoff_delay(attempt: int, base: float = 0.2, factor: float = 2.0, max_delay: float = 2.0) -> float:
+    """
+    Espera antes del reintento número `attempt` (1, 2, ...): mitad fija + mitad aleatoria,
+    para que varios workers no reintenten todos al mismo tiempo.
+    """
+    cap = min(max_delay, base * factor ** (attempt - 1))
+    return cap / 2 + random.uniform(0, cap / 2)
+
+def is_transient_error(exc: BaseException) -> bool:
+    """
+    Errores que vale la pena reintentar: fallos de conexión (la petición no llegó a
+    enviarse, incluye ConnectTimeout) o respuestas 5xx del servicio externo.
+    Un timeout de lectura NO se reintenta: el servicio pudo haberla procesado ya
+    (p. ej. Twilio aceptó el SMS) y el reintento la duplicaría.
+    """
+    if isinstance(exc, (ConnectionError, requests.exceptions.ConnectionError)):
+        return True
+    status = getattr(exc, "status", None) or getattr(getattr(exc, "response", None), "status_code", None)
+    return isinstance(status, int) and status >= 500
+
+def retry_call(fn: Callable[..., Any], *args: Any, attempts: int = 3,
+               retry_if: Callable[[BaseException], bool] = is_transient_error, **kwargs: Any) -> Any:
+    """
+    Ejecuta fn(*args, **kwargs) reintentando hasta `attempts` veces mientras retry_if(error) sea True.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt >= attempts or not retry_if(e):
+                raise
+            time.sleep(backoff_delay(attempt))
+
+# =========================
+# Circuit breaker
+# =========================
+class CircuitOpenError(RuntimeError):
+    """El circuito está abierto: el servicio externo se considera caído."""
+
+class CircuitBreaker:
+    """
+    Tras `fail_max` fallos seguidos abre el circuito y rechaza las llamadas durante
+    `reset_timeout` segundos. Pasado ese tiempo deja pasar llamadas de prueba: un
+    éxito lo cierra, un fallo lo vuelve a abrir.
+    Sólo cuentan como fallo las excepciones para las que failure_if(error) es True
+    (por defecto todas); el resto se propaga sin tocar el contador.
+    """
+
+    def __init__(self, name: str, fail_max: int = 5, reset_timeout: float = 30.0,
+                 failure_if: Optional[Callable[[BaseException], bool]] = None):
+        self.name = name
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self.failure_if = failure_if
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+
+    @property
+    def is_open(self) -> bool:
+        opened_at = self._opened_at
+        return opened_at is not None and time.monotonic() - opened_at < self.reset_timeout
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.fail_max:
+                if self._opened_at is None or not self.is_open:
+                    print(f"🚨 Circuito '{self.name}' abierto tras {self._failures} fallos seguidos.")
+                self._opened_at = time.monotonic()
+
+    def call(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Ejecuta fn a través del circuito; lanza CircuitOpenError si está abierto."""
+        if self.is_open:
+            raise CircuitOpenError(f"Servicio '{self.name}' no disponible temporalmente.")
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            if self.failure_if is None or self.failure_if(e):
+                self.record_failure()
+            raise
+        self.record_success()
+        return result
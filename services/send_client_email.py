@@ -1,6 +1,6 @@
 import os
 import re
-import json
+import orjson
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
@@ -24,11 +24,13 @@ AGENTS_DIR = os.path.join(BASE_DIR, "agents")
 # ==========================================================
 # 🔍 DETECTAR CORREO EN TEXTO
 # ==========================================================
+EMAIL_RE = re.compile(r'[\w\.-]+@[\w\.-]+\.\w+')
+
 def extract_email_from_text(text: str) -> str | None:
     """Busca un correo electrónico dentro del texto."""
     if not text:
         return None
-    match = re.search(r'[\w\.-]+@[\w\.-]+\.\w+', text)
+    match = EMAIL_RE.search(text)
     if match:
         return match.group(0).lower()
     return None
@@ -47,8 +49,8 @@ def get_agent_address(agent_slug: str) -> str | None:
             print(f"⚠️ No se encontró el archivo {agent_path}")
             return None
 
-        with open(agent_path, "r", encoding="utf-8") as file:
-            data = json.load(file)
+        with open(agent_path, "rb") as file:
+            data = orjson.loads(file.read())
 
             location = data.get("location", {})
             maps_url = location.get("maps_url")
@@ -1,8 +1,7 @@
-import json
 import logging
+import orjson
 import os
 from typing import Dict, Any, List, Optional
-import requests
 import traceback
 
 # Importar servicios
@@ -27,8 +26,8 @@ def _read_agent_config(agent_name: str) -> Dict[str, Any]:
         print(f"❌ No se encontró la configuración del agente: {json_path}")
         return {}
     try:
-        with open(json_path, "r", encoding="utf-8") as f:
-            return json.load(f) or {}
+        with open(json_path, "rb") as f:
+            return orjson.loads(f.read()) or {}
     except Exception as e:
         print(f"❌ Error leyendo JSON del agente {agent_name}: {e}")
         return {}